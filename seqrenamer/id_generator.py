@@ -1,6 +1,8 @@
 """ A generator that gives lexicographically orderable and selectable ids
 based on an integer """
 
+from itertools import islice, product, repeat
+
 
 class IdConverter(object):
 
@@ -26,17 +28,27 @@ class IdConverter(object):
 
         from baseconv import BaseConverter
         self.converter = BaseConverter(alphabet)
-        return
 
-    def encode(self, number: int) -> str:
-        """ Given an integer get the string representation. """
-
-        template = "{pre}{{p:{first}>{length}}}".format(
+        # The template doesn't change, so it's only built once.
+        self.template = "{pre}{{p:{first}>{length}}}".format(
             pre=self.prefix,
             first=self.converter.digits[0],
             length=self.length,
             )
-        return template.format(p=self.converter.encode(number))
+
+        self._ids = None
+        self._ids_state = None
+        return
+
+    def encode(self, number: int) -> str:
+        """ Given an integer get the string representation.
+
+        Examples:
+        >>> IdConverter(prefix="SR", length=3).encode(37)
+        'SR011'
+        """
+
+        return self.template.format(p=self.converter.encode(number))
 
     def decode(self, pattern: str) -> int:
         """ Given a string representation get the integer that produced it. """
@@ -44,9 +56,63 @@ class IdConverter(object):
         pattern = pattern[len(self.prefix):]
         return int(self.converter.decode(pattern))
 
+    def _generate(self, state: int):
+        """ Yields the ids for state and every number after it.
+        Counting up, the digits of the ids are just the cartesian product
+        of the alphabet, so we let itertools build them rather than
+        converting every number.
+
+        Examples:
+        >>> ids = IdConverter(length=1, alphabet="01")._generate(1)
+        >>> list(islice(ids, 5))
+        ['1', '10', '11', '100', '101']
+        """
+
+        alphabet = self.alphabet
+        base = len(alphabet)
+        add_prefix = self.prefix.__add__
+
+        # Ids shorter than length are padded with the first digit, so the
+        # first block can start with it. Longer ones never do.
+        width = max(self.length, 1)
+        lower = 0
+        while True:
+            upper = base ** width
+            if state < upper:
+                if lower == 0:
+                    digits = product(alphabet, repeat=width)
+                else:
+                    digits = product(
+                        alphabet[1:],
+                        *repeat(alphabet, width - 1)
+                    )
+
+                digits = islice(digits, state - lower, None)
+                yield from map(add_prefix, map("".join, digits))
+                state = upper
+
+            lower = upper
+            width += 1
+
     def __next__(self):
-        string = self.encode(self.state)
+        """ Gets the id for the current state and moves to the next one.
+
+        Examples:
+        >>> id_conv = IdConverter(prefix="SR", length=2)
+        >>> next(id_conv), next(id_conv)
+        ('SR00', 'SR01')
+        >>> id_conv.state = 36 ** 2 - 1
+        >>> next(id_conv), next(id_conv)
+        ('SRZZ', 'SR100')
+        """
+
+        # Start again if the state has been changed from outside.
+        if self.state != self._ids_state:
+            self._ids = self._generate(self.state)
+
+        string = next(self._ids)
         self.state += 1
+        self._ids_state = self.state
         return string
 
     def __iter__(self):
@@ -1,17 +1,21 @@
+import os
 import sys
 import argparse
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from tempfile import TemporaryDirectory
 
+import re
 from copy import copy
-import csv
-
-from gffpal.gff import GFFRecord
 
 from seqrenamer.exceptions import MapFileParseError
 from seqrenamer.exceptions import MapFileKeyError
 from seqrenamer.exceptions import XsvColumnNumberError
-from seqrenamer.seq import Seq, Seqs
-from seqrenamer.xsv import Xsv
+from seqrenamer.seq import Seq
+from seqrenamer.xsv import Xsv, write_rows
 from seqrenamer.scripts.encode import check_format, check_column, join_files
+from seqrenamer.scripts.encode import buffered_writer, BUFFER_SIZE
 from seqrenamer.scripts.encode import FORMATS
 
 
@@ -82,33 +86,88 @@ def cli_decode(parser):
     return
 
 
-def parse_map_file(infile):
-    """ Parse a map file to use for renaming outputs. """
+def parse_map_file(infile, binary=False):
+    """ Parse a map file to use for renaming outputs.
+
+    Most map files are one-to-one, so values are stored as plain strings
+    unless some key has multiple values, in which case all values are
+    stored as tuples.
+
+    Keyword arguments:
+    infile -- An iterable of lines from the map file.
+    binary -- The lines are bytes, keys and values will be bytes too.
+
+    Returns:
+    Tuple -- the map dictionary and whether it is flat (one-to-one).
+
+    Examples:
+    >>> parse_map_file(["SR1\\ta\\n", "SR2\\tb\\n"])
+    ({'SR1': 'a', 'SR2': 'b'}, True)
+    >>> parse_map_file(["SR1\\ta\\n", "SR1\\tb\\n", "SR2\\tc\\n"])
+    ({'SR1': ('a', 'b'), 'SR2': ('c',)}, False)
+    >>> parse_map_file([b"SR1\\ta\\n"], binary=True)
+    ({b'SR1': b'a'}, True)
+    """
 
-    from collections import defaultdict
-    map_ = defaultdict(list)
+    map_ = dict()
+    map_get = map_.get
+    flat = True
+
+    tab = b"\t" if binary else "\t"
 
     for i, line in enumerate(infile, 1):
         try:
-            sline = line.strip().split("\t")
-            map_[sline[0]].append(sline[1])
+            # Only the first two columns are used, don't split the rest.
+            sline = line.strip().split(tab, 2)
+            value = sline[1]
         except IndexError:
+            if binary:
+                line = line.decode(errors="replace")
+
             raise MapFileParseError(
                 f"Error parsing map file at line {i}. "
                 f"The offending line was: {line}"
             )
 
-    return map_
+        # Old values often repeat (e.g. descriptions, or rows from xsv
+        # files), interning keeps a single copy of each.
+        if not binary:
+            value = sys.intern(value)
+
+        # Lists are only created for keys that we've seen before.
+        key = sline[0]
+        existing = map_get(key)
+        if existing is None:
+            map_[key] = value
+        elif isinstance(existing, list):
+            existing.append(value)
+        else:
+            map_[key] = [existing, value]
+            flat = False
+
+    # Tuples are allocated at their final size, unlike the growing lists.
+    if not flat:
+        map_ = {
+            k: tuple(v) if isinstance(v, list) else (v,)
+            for k, v
+            in map_.items()
+        }
+
+    return map_, flat
+
+
+def map_key_error(key):
+    return MapFileKeyError(
+        f"Key {key} is not in map file. "
+        "Have you selected the right column?"
+    )
 
 
 def get_from_map(map, key):
     try:
         return map[key]
     except KeyError:
-        raise MapFileKeyError(
-            f"Key {key} is not in map file. "
-            "Have you selected the right column?"
-        )
+        raise map_key_error(key)
 
 
 def get_from_map_single(map, key):
@@ -121,25 +180,132 @@ def get_from_map_single(map, key):
         )
 
 
-def decode_seqs(infiles, outfile, map_, column):
-    seqs = Seqs.parse_many(infiles)
+def decode_seqs(infiles, outfile, map_, column, flat=False):
+    """ Substitutes the fasta ids or descriptions using the map.
+
+    Each file is memory mapped (or read as a single block of bytes) and
+    the headers are found with find, so we never need to split the whole
+    file into lines. The sequence lines are copied through as they are.
+
+    The infiles may be opened in text or binary mode.
+    The map should have been parsed with binary=True.
+    """
 
-    chunk = list()
-    for i, seq in enumerate(seqs, 1):
+    # Output is built as bytes and written to the underlying binary file.
+    out = bytearray()
+    write = outfile.buffer.write
+
+    for infile in infiles:
+        records = Seq.scan_file(infile)
+
+        # The column is checked once per file rather than every record.
         if column == "description":
-            old_descs = get_from_map(map_, seq.desc)
-            for old_desc in old_descs:
-                chunk.append(str(Seq(seq.id, old_desc, seq.seq)))
+            for id_, desc, body in records:
+                try:
+                    old_descs = map_[desc]
+                except KeyError:
+                    raise map_key_error(desc and desc.decode())
+
+                if flat:
+                    old_descs = (old_descs,)
+
+                for old_desc in old_descs:
+                    out += b">%s %s\n" % (id_, old_desc)
+                    out += body
+
+                if len(out) >= BUFFER_SIZE:
+                    write(out)
+                    out.clear()
         else:
-            old_ids = get_from_map(map_, seq.id)
-            for old_id in old_ids:
-                chunk.append(str(Seq(old_id, seq.desc, seq.seq)))
+            for id_, desc, body in records:
+                try:
+                    old_ids = map_[id_]
+                except KeyError:
+                    raise map_key_error(id_.decode())
+
+                if flat:
+                    old_ids = (old_ids,)
+
+                for old_id in old_ids:
+                    if desc is None:
+                        out += b">%s\n" % old_id
+                    else:
+                        out += b">%s %s\n" % (old_id, desc)
+                    out += body
+
+                if len(out) >= BUFFER_SIZE:
+                    write(out)
+                    out.clear()
+
+    write(out)
+    return
+
+
+# The map is shared with the worker processes through this global,
+# so that forked workers inherit it rather than having it pickled.
+_WORKER_ARGS = None
+
+
+def _init_decode_seqs_worker(map_, column, flat):
+    global _WORKER_ARGS
+    _WORKER_ARGS = (map_, column, flat)
+    return
 
-        if i % 10000 == 0:
-            outfile.write(''.join(chunk))
-            chunk = []
 
-    outfile.write(''.join(chunk))
+def _decode_seqs_worker(infile_path, outfile_path):
+    map_, column, flat = _WORKER_ARGS
+
+    with open(infile_path, "rb") as infile, \
+            open(outfile_path, "w") as outfile:
+        decode_seqs([infile], outfile, map_, column, flat)
+    return outfile_path
+
+
+def decode_seqs_parallel(infiles, outfile, map_, column, flat=False):
+    """ Decodes multiple fasta files, one file per worker process.
+
+    Each worker writes its file to a temporary file, which are copied to
+    the outfile in the original order.
+    Falls back to decode_seqs if there's only one cpu or if any of the
+    files can't be reopened by name (e.g. stdin).
+    """
+
+    paths = [getattr(f, "name", None) for f in infiles]
+    nworkers = min(len(paths), os.cpu_count() or 1)
+
+    if (nworkers < 2) or not all(
+        isinstance(p, str) and os.path.isfile(p)
+        for p
+        in paths
+    ):
+        decode_seqs(infiles, outfile, map_, column, flat)
+        return
+
+    # Fork lets the workers share the map without copying it up front.
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = None
+
+    with TemporaryDirectory() as tmpdir:
+        tmp_paths = [
+            os.path.join(tmpdir, f"{i}.fasta")
+            for i
+            in range(len(paths))
+        ]
+
+        with ProcessPoolExecutor(
+            max_workers=nworkers,
+            mp_context=context,
+            initializer=_init_decode_seqs_worker,
+            initargs=(map_, column, flat),
+        ) as executor:
+            results = executor.map(_decode_seqs_worker, paths, tmp_paths)
+
+            for tmp_path in results:
+                with open(tmp_path, "rb") as handle:
+                    shutil.copyfileobj(handle, outfile.buffer, BUFFER_SIZE)
+                os.remove(tmp_path)
     return
 
 
@@ -151,84 +317,162 @@ def decode_xsv(
     comment,
     header,
     sep,
+    flat=False,
 ):
-    xsv_writer = csv.writer(outfile, delimiter=sep, dialect='excel')
-
     inhandles = join_files(infiles, header)
     xsv_reader = Xsv(inhandles, comment, sep)
 
+    # Rows are written in batches to avoid lots of small writes.
+    rows_out = list()
+    rows_out_append = rows_out.append
+
     first = True
     for row in xsv_reader:
         if header and first:
-            xsv_writer.writerow(row)
+            rows_out_append(row)
             first = False
             continue
 
         try:
-            old_vals = get_from_map(map_, row[column])
-
-            # Reduplicate results
-            for old_val in old_vals:
-                new_row = copy(row)
-                new_row[column] = old_val
-                xsv_writer.writerow(new_row)
-
+            key = row[column]
         except IndexError:
             joined_line = sep.join(map(str, row))
             raise XsvColumnNumberError(
                 f"Could not access column '{column}' in a line. "
                 f"The offending line was: {joined_line}."
             )
+
+        try:
+            old_vals = map_[key]
+        except KeyError:
+            raise map_key_error(key)
+
+        if flat:
+            # One-to-one, so we can just update the row in place.
+            row[column] = old_vals
+            rows_out_append(row)
+        else:
+            # Reduplicate results
+            for old_val in old_vals:
+                new_row = copy(row)
+                new_row[column] = old_val
+                rows_out_append(new_row)
+
+        if len(rows_out) >= 10000:
+            write_rows(outfile, rows_out, sep)
+            rows_out.clear()
+
+    write_rows(outfile, rows_out, sep)
     return
 
 
-def replace_gff_id(record, map_):
-    old_id = record.attributes.id
-    old_parents = record.attributes.parent
+# Characters that must be escaped in gff3 attribute values.
+GFF_ESCAPES = str.maketrans({
+    "\t": "%09",
+    "\n": "%0A",
+    "\r": "%0D",
+    "%": "%25",
+    "&": "%26",
+    ",": "%2C",
+    ";": "%3B",
+    "=": "%3D",
+})
 
-    if old_id is not None:
-        new_id = get_from_map_single(map_, old_id)
-        record.attributes.id = new_id
+GFF_ID_REGEX = re.compile(r"(?<![^;])(ID|Parent)=([^;]*)")
+GFF_NAME_REGEX = re.compile(r"(?<![^;])Name=([^;]*)")
 
-    new_parents = []
-    for old_parent in old_parents:
-        new_parent = get_from_map_single(map_, old_parent)
-        new_parents.append(new_parent)
 
-    record.attributes.parent = new_parents
-    return record
+def replace_gff_id(line, map_, flat=False):
+    """ Substitutes the ID and Parent attributes of a gff line.
 
+    Examples:
+    >>> line = "chr1\\t.\\tmRNA\\t1\\t9\\t.\\t+\\t.\\tID=SR2;Parent=SR1"
+    >>> replace_gff_id(line, {"SR1": "gene;1", "SR2": "mrna1"}, flat=True)
+    ['chr1\\t.\\tmRNA\\t1\\t9\\t.\\t+\\t.\\tID=mrna1;Parent=gene%3B1']
+    """
 
-def replace_gff_name(record, map_):
-    old_name = record.attributes.name
+    head, tab, attributes = line.rpartition("\t")
 
-    out_records = list()
-    if old_name is not None:
-        new_names = get_from_map(map_, old_name)
-        for new_name in new_names:
-            new_record = copy(record)
-            new_attributes = copy(record.attributes)
-            new_attributes.name = new_name
-            new_record.attributes = new_attributes
-            out_records.append(new_record)
+    def replace(match):
+        old_ids = match.group(2).split(",")
 
-    return out_records
+        if flat:
+            try:
+                new_ids = [map_[old_id] for old_id in old_ids]
+            except KeyError as e:
+                raise map_key_error(e.args[0])
+        else:
+            new_ids = [
+                get_from_map_single(map_, old_id)
+                for old_id
+                in old_ids
+            ]
+
+        new_ids = ",".join(new_id.translate(GFF_ESCAPES) for new_id in new_ids)
+        return f"{match.group(1)}={new_ids}"
+
+    return [head + tab + GFF_ID_REGEX.sub(replace, attributes)]
+
+
+def replace_gff_name(line, map_, flat=False):
+    """ Substitutes the Name attribute of a gff line.
+
+    Examples:
+    >>> line = "chr1\\t.\\tgene\\t1\\t9\\t.\\t+\\t.\\tID=g1;Name=SR1"
+    >>> replace_gff_name(line, {"SR1": ["one", "two"]})[1]
+    'chr1\\t.\\tgene\\t1\\t9\\t.\\t+\\t.\\tID=g1;Name=two'
+    >>> line = "chr1\\t.\\tgene\\t1\\t9\\t.\\t+\\t.\\tName=SR1;ID=g1"
+    >>> replace_gff_name(line, {"SR1": ["one"]})
+    ['chr1\\t.\\tgene\\t1\\t9\\t.\\t+\\t.\\tName=one;ID=g1']
+    >>> line = "chr1\\t.\\tgene\\t1\\t9\\t.\\t+\\t.\\tID=g1"
+    >>> replace_gff_name(line, {"SR1": ["one"]})
+    ['chr1\\t.\\tgene\\t1\\t9\\t.\\t+\\t.\\tID=g1']
+    """
+
+    head, tab, attributes = line.rpartition("\t")
+    match = GFF_NAME_REGEX.search(attributes)
+
+    if match is None:
+        return [line]
+
+    new_names = get_from_map(map_, match.group(1))
+    if flat:
+        new_names = (new_names,)
 
+    head = head + tab + attributes[:match.start(1)]
+    tail = attributes[match.end(1):]
+    return [
+        head + new_name.translate(GFF_ESCAPES) + tail
+        for new_name
+        in new_names
+    ]
 
-def replace_gff_seqid(record, map_):
-    old_seqid = record.seqid
-    new_seqids = get_from_map(map_, old_seqid)
 
-    out_records = list()
-    for new_seqid in new_seqids:
-        new_record = copy(record)
-        new_record.seqid = new_seqid
-        out_records.append(new_record)
+def replace_gff_seqid(line, map_, flat=False):
+    """ Substitutes the seqid (first) column of a gff line.
 
-    return out_records
+    Examples:
+    >>> line = "SR1\\t.\\tgene\\t1\\t9\\t.\\t+\\t.\\tID=g1"
+    >>> replace_gff_seqid(line, {"SR1": "chr1"}, flat=True)
+    ['chr1\\t.\\tgene\\t1\\t9\\t.\\t+\\t.\\tID=g1']
+    """
 
+    seqid, tab, rest = line.partition("\t")
+
+    new_seqids = get_from_map(map_, seqid)
+    if flat:
+        return [new_seqids + tab + rest]
+
+    return [new_seqid + tab + rest for new_seqid in new_seqids]
+
+
+def decode_gff(infiles, outfile, map_, column, flat=False):
+    """ Substitutes gff ids using the map.
+
+    Lines are rewritten as text, so only the column that we're replacing
+    is touched and we avoid parsing every record.
+    """
 
-def decode_gff(infiles, outfile, map_, column):
     inhandles = join_files(infiles, header=False)
 
     if column == "id":
@@ -241,21 +485,22 @@ def decode_gff(infiles, outfile, map_, column):
         raise ValueError("This shouldn't ever happen")
 
     record_chunk = list()
-    for i, line in enumerate(inhandles):
+    for i, line in enumerate(inhandles, 1):
         if line.startswith("#"):
             record_chunk.append(line.strip())
             continue
 
-        old_record = GFFRecord.parse(line)
-        new_records = trans_function(old_record, map_)
-        record_chunk.append(str(new_records))
+        line = line.rstrip("\r\n")
+        record_chunk.extend(trans_function(line, map_, flat))
 
         if i % 10000 == 0:
             outfile.write("\n".join(record_chunk))
+            outfile.write("\n")
             record_chunk = list()
 
     if len(record_chunk) > 0:
         outfile.write("\n".join(record_chunk))
+        outfile.write("\n")
 
     return
 
@@ -264,27 +509,39 @@ def decode(args):
     format = check_format(args.format, args.infiles)
     column = check_column(args.column, format)
 
-    map_ = parse_map_file(args.map)
+    outfile = buffered_writer(args.outfile)
 
     if format == "fasta":
-        decode_seqs(args.infiles, args.outfile, map_, column)
+        # Fasta is decoded as bytes so the map is too.
+        map_, flat = parse_map_file(args.map.buffer, binary=True)
+    else:
+        map_, flat = parse_map_file(args.map)
+
+    if format == "fasta" and len(args.infiles) > 1:
+        decode_seqs_parallel(args.infiles, outfile, map_, column, flat)
+    elif format == "fasta":
+        decode_seqs(args.infiles, outfile, map_, column, flat)
     elif format in ("csv", "tsv"):
         decode_xsv(
             args.infiles,
-            args.outfile,
+            outfile,
             map_,
             column,
             args.comment,
             args.header,
             ',' if format == "csv" else '\t',
+            flat,
         )
     elif format == "gff3":
         decode_gff(
             args.infiles,
-            args.outfile,
+            outfile,
             map_,
             column,
+            flat,
         )
     else:
         raise ValueError("This shouldn't ever happen")
+
+    outfile.flush()
     return
@@ -1,15 +1,13 @@
 import sys
 import argparse
 
-import csv
+from itertools import chain
 from os.path import splitext
 
-from gffpal.gff import GFFRecord
-
 from seqrenamer.seq import Seqs
 from seqrenamer.id_generator import IdConverter
 from seqrenamer.exceptions import InvalidArgumentError
-from seqrenamer.xsv import Xsv
+from seqrenamer.xsv import Xsv, write_rows
 
 
 FORMATS = ["fasta", "tsv", "csv", "gff3"]
@@ -26,6 +24,31 @@ EXTENSIONS = {
     ".gff": "gff3",
 }
 
+# Size of the write buffer for output files.
+BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def buffered_writer(handle, buffer_size=BUFFER_SIZE):
+    """ Opens a new text writer with a large buffer over an output handle.
+
+    This saves us from making lots of small writes when the output is
+    stdout (which may be line buffered) or a default-buffered file.
+    Writes larger than the buffer bypass it entirely, so it's still worth
+    joining chunks before writing them.
+
+    The underlying file descriptor is not closed with the new writer,
+    so remember to flush it when you're done.
+    """
+
+    handle.flush()
+    return open(
+        handle.fileno(),
+        "w",
+        buffering=buffer_size,
+        encoding=handle.encoding,
+        closefd=False,
+    )
+
 
 def cli_encode(parser):
 
@@ -247,6 +270,14 @@ def check_format(format, infiles):
     'csv'
     >>> check_format("auto", [DummyFile("test.csv"), DummyFile("test.tsv")])
     'csv'
+    >>> check_format("auto", [DummyFile("TEST.FASTA")])
+    'fasta'
+    >>> all(
+    ...     check_format("auto", [DummyFile("test" + ext)]) == format
+    ...     for ext, format
+    ...     in EXTENSIONS.items()
+    ... )
+    True
     >>> try:
     ...     check_format("auto", [DummyFile("test")])  # No extension fail.
     ...     assert False  # We shouldn't reach this point.
@@ -267,8 +298,8 @@ def check_format(format, infiles):
     except AttributeError:
         raise InvalidArgumentError(msg)
 
-    extension = splitext(filename)
-    format = EXTENSIONS.get(extension[1], None)
+    extension = splitext(filename)[1].lower()
+    format = EXTENSIONS.get(extension, None)
 
     if format is None:
         raise InvalidArgumentError(msg)
@@ -289,46 +320,64 @@ def encode_seqs(
 ):
     seqs = Seqs.parse_many(infiles)
 
+    # The sequence edits are applied together in one pass.
+    steps = list()
     if strip is not None:
-        seqs = seqs.map_seq(lambda s: s.rstrip(strip.encode()))
+        strip = strip.encode()
+        steps.append(("seq", lambda s: s.rstrip(strip)))
 
     if upper:
-        seqs = seqs.map_seq(lambda s: s.upper())
+        steps.append(("seq", bytes.upper))
+
+    if len(steps) > 0:
+        seqs = seqs.pipeline(*steps)
 
     if deduplicate:
         seqs = seqs.deduplicated(lambda i: next(id_conv), column=column)
     else:
-        seqs = seqs.replace_ids(lambda i: next(id_conv), column=column)
+        # Every id gets a fresh one from id_conv, so repeats aren't tracked.
+        seqs = seqs.replace_ids(
+            lambda i: next(id_conv),
+            column=column,
+            unique_ids=True
+        )
 
-    chunk = list()
-    for i, seq in enumerate(seqs, 1):
-        if drop_desc:
-            seq.desc = None
+    # Records are written as bytes to skip decoding the sequences.
+    write = outfile.buffer.write
 
-        chunk.append(str(seq))
+    for batch in seqs.batched(10000):
+        if drop_desc:
+            for seq in batch:
+                seq.desc = None
 
-        if i % 10000 == 0:
-            outfile.write(''.join(chunk))
-            chunk = []
-            seqs.flush_ids(mapfile)
+        write(b''.join([seq.to_bytes() for seq in batch]))
+        seqs.flush_ids(mapfile)
 
-    outfile.write(''.join(chunk))
+    # Duplicates after the last output sequence are still in the map.
     seqs.flush_ids(mapfile)
     return
 
 
 def join_files(infiles, header=False):
-    first = True
+    """ Chains the lines from several files together.
+    Lines keep their line endings.
 
-    for f in infiles:
-        if header and not first:
-            # Drop the first line
-            _ = next(f)
+    Keyword arguments:
+    infiles -- A list of open files.
+    header -- Drop the first line of every file after the first.
 
-        first = False
-        for line in f:
-            yield line.rstrip("\r\n")
-    return
+    Examples:
+    >>> from io import StringIO
+    >>> infiles = [StringIO("h\\na\\n"), StringIO("h\\nb")]
+    >>> list(join_files(infiles, header=True))
+    ['h\\n', 'a\\n', 'b']
+    """
+
+    if header:
+        for f in infiles[1:]:
+            next(f, None)
+
+    return chain.from_iterable(infiles)
 
 
 def encode_xsv(
@@ -341,18 +390,22 @@ def encode_xsv(
     sep,
     id_conv
 ):
-    xsv_writer = csv.writer(outfile, delimiter=sep, dialect='excel')
-
     inhandles = join_files(infiles, header)
     xsv_reader = Xsv(inhandles, comment, sep)
     iterator = xsv_reader.replace_ids(lambda r: next(id_conv), column, header)
 
-    for i, row in enumerate(iterator, 1):
-        xsv_writer.writerow(row)
+    rows_out = list()
+    rows_out_append = rows_out.append
 
-        if i % 10000 == 0:
+    for row in iterator:
+        rows_out_append(row)
+
+        if len(rows_out) >= 10000:
+            write_rows(outfile, rows_out, sep)
+            rows_out.clear()
             xsv_reader.flush_ids(mapfile)
 
+    write_rows(outfile, rows_out, sep)
     xsv_reader.flush_ids(mapfile)
     return
 
@@ -424,6 +477,10 @@ def encode_gff(
     column,
     id_conv,
 ):
+    # gffpal is only needed here, so don't make the other formats
+    # pay for importing it.
+    from gffpal.gff import GFFRecord
+
     inhandles = join_files(infiles, header=False)
     seen = dict()
 
@@ -439,12 +496,12 @@ def encode_gff(
     id_chunk = list()
     record_chunk = list()
 
-    for i, line in enumerate(inhandles):
+    for i, line in enumerate(inhandles, 1):
         if line.startswith("#"):
             record_chunk.append(line.strip())
             continue
 
-        old_record = GFFRecord.parse(line)
+        old_record = GFFRecord.parse(line.rstrip("\r\n"))
         new_record = trans_function(
             old_record,
             seen,
@@ -478,11 +535,14 @@ def encode(args):
 
     id_conv = IdConverter(prefix=args.prefix, length=args.length)
 
+    outfile = buffered_writer(args.outfile)
+    mapfile = buffered_writer(args.map)
+
     if format == "fasta":
         encode_seqs(
             args.infiles,
-            args.outfile,
-            args.map,
+            outfile,
+            mapfile,
             column,
             args.deduplicate,
             args.upper,
@@ -493,8 +553,8 @@ def encode(args):
     elif format in ("csv", "tsv"):
         encode_xsv(
             args.infiles,
-            args.outfile,
-            args.map,
+            outfile,
+            mapfile,
             column,
             args.comment,
             args.header,
@@ -504,12 +564,14 @@ def encode(args):
     elif format == "gff3":
         encode_gff(
             args.infiles,
-            args.outfile,
-            args.map,
+            outfile,
+            mapfile,
             column,
             id_conv,
         )
     else:
         raise ValueError("This shouldn't happen")
 
+    outfile.flush()
+    mapfile.flush()
     return
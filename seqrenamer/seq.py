@@ -1,10 +1,18 @@
 """ Simple fasta parser and utilities. """
 
+import io
+import mmap
 from collections.abc import Iterator
+from itertools import islice
+from hashlib import sha1
+from binascii import b2a_base64
 
 
 class Seq(object):
 
+    # Lots of these are created, so skip the per-instance __dict__.
+    __slots__ = ("id", "desc", "seq")
+
     def __init__(self, id, desc, seq):
         """ Construct a new Seq object.
 
@@ -39,17 +47,46 @@ class Seq(object):
         <BLANKLINE>
         """
 
-        line_length = 60
+        return self._header() + self.wrapped().decode("utf-8")
+
+    def to_bytes(self):
+        """ Returns the FASTA record as bytes.
+        This avoids decoding the sequence if you're writing to a binary file.
+
+        Examples:
+        >>> Seq("test", "description", "ATGCA").to_bytes()
+        b'>test description\\nATGCA\\n'
+        """
 
+        return self._header().encode() + self.wrapped()
+
+    def _header(self):
         if self.desc is None:
-            lines = [">{}".format(self.id)]
+            return ">{}\n".format(self.id)
         else:
-            lines = [">{} {}".format(self.id, self.desc)]
+            return ">{} {}\n".format(self.id, self.desc)
+
+    def wrapped(self, line_length=60):
+        """ Returns the sequence as bytes split into lines.
+        Every line, including the last one, ends with a newline.
+
+        Examples:
+        >>> Seq("test", None, "ATGCA").wrapped(line_length=2)
+        b'AT\\nGC\\nA\\n'
+        >>> Seq("test", None, "").wrapped()
+        b''
+        """
 
-        for i in range(0, len(self), line_length):
-            lines.append(self.seq[i:i+line_length].decode("utf-8"))
+        seq = self.seq
+        lines = [
+            seq[i:i + line_length]
+            for i
+            in range(0, len(seq), line_length)
+        ]
 
-        return "\n".join(lines) + "\n"
+        # Gives us the trailing newline (and nothing for an empty seq).
+        lines.append(b"")
+        return b"\n".join(lines)
 
     def __repr__(self):
         """ Returns a simple string representation of the object. """
@@ -161,6 +198,11 @@ class Seq(object):
         Seq(id='test2', desc='descr', seq='b'TGACA'')
         """
 
+        # Real files can be read in blocks instead of line by line.
+        if hasattr(handle, "buffer") or isinstance(handle, io.BufferedIOBase):
+            yield from cls.parse_buffered(handle, comment=comment)
+            return
+
         # Store the initial state to avoid outputting empty record.
         first = True
         # Store lines for this block here.
@@ -190,15 +232,229 @@ class Seq(object):
         yield cls.read(current_record)
         return
 
+    @classmethod
+    def parse_buffered(cls, handle, comment=";", bufsize=65536):
+        """ Parse multiple fasta records from a file in large blocks.
+        Rather than handling the file line by line, we read blocks of bytes
+        and find the complete records in each block with scan.
+        Regular files are memory mapped and scanned in one go instead.
+        Whitespace within the sequences is removed in a single pass.
+
+        Keyword arguments:
+        handle -- A file opened in text or binary mode.
+        comment -- Lines in the sequence starting with this are skipped.
+        bufsize -- The number of bytes to read at a time.
+
+        Yields:
+        Seq objects.
+
+        Examples:
+        >>> from io import BytesIO
+        >>> fasta = b">test1 description\\nATG\\n;note\\nCA\\n>test2\\nT"
+        >>> seqs = Seq.parse_buffered(BytesIO(fasta), bufsize=4)
+        >>> next(seqs)
+        Seq(id='test1', desc='description', seq='b'ATGCA'')
+        >>> next(seqs)
+        Seq(id='test2', desc='None', seq='b'T'')
+        """
+
+        # Text files are read from their underlying binary buffer.
+        handle = getattr(handle, "buffer", handle)
+        comment = comment.encode()
+
+        try:
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Not a regular file, or an empty one.
+            pass
+        else:
+            yield from cls._parse_block(mapped, comment)
+            return
+
+        read = handle.read
+        buf = bytearray()
+        while True:
+            block = read(bufsize)
+            if not block:
+                break
+
+            buf += block
+
+            # Only look for the last record start in the new part of the
+            # buffer, otherwise long sequences would be searched repeatedly.
+            last = buf.rfind(b"\n>", max(0, len(buf) - len(block) - 1))
+            if last == -1:
+                continue
+
+            yield from cls._parse_block(bytes(buf[:last + 1]), comment)
+            del buf[:last + 1]
+
+        yield from cls._parse_block(bytes(buf), comment)
+        return
+
+    @classmethod
+    def _parse_block(cls, block, comment):
+        """ Parses the complete fasta records in a block of bytes. """
+
+        for id_, desc, body in cls.scan(block, comment):
+            yield cls(
+                id_.decode(),
+                None if desc is None else desc.decode(),
+                body.translate(None, b" \t\r\n\x0b\x0c"),
+            )
+        return
+
     @classmethod
     def parse_many(cls, handles, comment=";"):
         """ Parses many files yielding an iterator over all of them. """
 
         for handle in handles:
-            for record in cls.parse(handle, comment=";"):
+            for record in cls.parse(handle, comment=comment):
                 yield record
         return
 
+    @classmethod
+    def scan(cls, buf, comment=b";"):
+        """ Find the fasta records in a buffer of bytes.
+        Unlike parse, clean sequence lines are left exactly as they are in
+        the buffer, so records can be rewritten without re-wrapping them.
+        Bodies containing comments, blank lines or carriage returns are
+        cleaned up and re-wrapped, as parse and str(Seq) would do.
+
+        Keyword arguments:
+        buf -- A bytes-like object containing the whole fasta file.
+        comment -- Lines in the sequence starting with this are skipped.
+
+        Yields:
+        Tuples of id, description and body bytes, where body contains the
+        (newline terminated) sequence lines.
+
+        Examples:
+        >>> fasta = b">test1 description\\nATG\\nCA\\n>test2\\nTGACA"
+        >>> seqs = Seq.scan(fasta)
+        >>> next(seqs)
+        (b'test1', b'description', b'ATG\\nCA\\n')
+        >>> next(seqs)
+        (b'test2', None, b'TGACA\\n')
+        """
+
+        find = buf.find
+        size = len(buf)
+        clean_body = cls._clean_body
+        dirty = (b"\r", b"\n\n", b"\n" + comment)
+
+        # Most files have nothing to clean up, so only check each record if
+        # there is something to find in the file.
+        check = any(find(d) != -1 for d in dirty)
+
+        # Text before the first header doesn't belong to any record, so
+        # it's skipped.
+        # NB. mmap objects don't have startswith.
+        if buf[:1] == b">":
+            start = 0
+        else:
+            start = find(b"\n>")
+            if start != -1:
+                start += 1
+
+        while start != -1:
+            header_end = find(b"\n", start)
+            if header_end == -1:
+                header_end = size
+
+            next_start = find(b"\n>", header_end)
+            if next_start == -1:
+                end = size
+            else:
+                end = next_start + 1
+                next_start = end
+
+            # Strip the ">" character and split at most 1 time on spaces.
+            sline = buf[start + 1:header_end].rstrip().split(b" ", 1)
+            body = buf[header_end + 1:end]
+
+            if check and (
+                body.startswith(comment)
+                or body.startswith(b"\n")
+                or any(d in body for d in dirty)
+            ):
+                body = clean_body(body, comment)
+            elif body and not body.endswith(b"\n"):
+                # The last line in the file might not have a newline.
+                body += b"\n"
+
+            if len(sline) == 1:
+                yield sline[0], None, body
+            else:
+                yield sline[0], sline[1], body
+
+            start = next_start
+        return
+
+    @staticmethod
+    def _clean_body(body, comment, line_length=60):
+        """ Drops comments and whitespace from a sequence body and wraps it.
+
+        Examples:
+        >>> body = b";note\\nAC\\r\\n\\r\\nGT\\r\\n"
+        >>> Seq._clean_body(body, b";", line_length=3)
+        b'ACG\\nT\\n'
+        """
+
+        seq = b"".join(
+            line
+            for line
+            in body.split(b"\n")
+            if not line.startswith(comment)
+        )
+        seq = seq.translate(None, b" \t\r\n\x0b\x0c")
+        return b"".join([
+            seq[i:i + line_length] + b"\n"
+            for i
+            in range(0, len(seq), line_length)
+        ])
+
+    @classmethod
+    def scan_file(cls, handle):
+        """ Find the fasta records in a file.
+        Regular files are memory mapped, so the whole file never needs
+        to be read into memory. Anything else (e.g. pipes) is read in one
+        go and passed to scan.
+
+        Keyword arguments:
+        handle -- A file opened in text or binary mode.
+
+        Yields:
+        Tuples of id, description and body bytes, as for scan.
+
+        Examples:
+        >>> from io import BytesIO
+        >>> seqs = Seq.scan_file(BytesIO(b">test1\\nATGCA\\n"))
+        >>> next(seqs)
+        (b'test1', None, b'ATGCA\\n')
+
+        Comments, blank lines and CRLF line endings are cleaned up to match
+        the line based parser.
+        >>> fasta = b">test1 d\\nACGT\\n;note\\nTT\\n"
+        >>> fasta += b">test2\\r\\nAC\\r\\n\\r\\nGT\\r\\n"
+        >>> list(Seq.scan_file(BytesIO(fasta)))
+        [(b'test1', b'd', b'ACGTTT\\n'), (b'test2', None, b'ACGT\\n')]
+        >>> lines = fasta.decode().splitlines()
+        >>> [str(s).split("\\n", 1)[1] for s in Seq.parse(lines)]
+        ['ACGTTT\\n', 'ACGT\\n']
+        """
+
+        # Text files are read from their underlying binary buffer.
+        handle = getattr(handle, "buffer", handle)
+
+        try:
+            buf = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Not a regular file, or an empty one.
+            buf = handle.read()
+
+        return cls.scan(buf)
+
     @staticmethod
     def _split_id_line(line):
         """ Parse the FASTA header line into id and description components.
@@ -233,13 +489,34 @@ class Seq(object):
         # We should never reach this point.
         return
 
+    def digest(self):
+        """ Returns the raw SHA-1 digest of the sequence.
+        This is cheaper to compare and hash than the seguid checksum.
+        """
+
+        return sha1(self.seq).digest()
+
     def checksum(self):
-        """ Returns the seguid checksum of a sequence. """
+        """ Returns the seguid checksum of a sequence.
+
+        Examples:
+        >>> Seq("test", None, "ATGCA").checksum()
+        'HBVb0amOaTCyKQBLO6sPsybmZcs'
+        """
+
+        return self.seguid(self.digest())
+
+    @staticmethod
+    def seguid(digest):
+        """ Formats a raw SHA-1 digest as a seguid checksum.
+
+        Examples:
+        >>> seq = Seq("test", None, "ATGCA")
+        >>> Seq.seguid(seq.digest()) == seq.checksum()
+        True
+        """
 
-        from hashlib import sha1
-        from base64 import b64encode
-        hash_ = sha1(self.seq).digest()
-        return b64encode(hash_).rstrip(b"=").decode("utf-8")
+        return b2a_base64(digest, newline=False).rstrip(b"=").decode()
 
     def rstrip(self, chars):
         """ Strips some bytes from the end of the sequence.
@@ -421,6 +698,82 @@ class Seqs(object):
 
         return self.filter(lambda s: len(s) <= length)
 
+    def batched(self, n=1024):
+        """ Yields the sequences in lists of up to n at a time.
+
+        Examples:
+        >>> inseqs = [Seq('test1', None, "A"), Seq('test2', None, "T")]
+        >>> [len(b) for b in Seqs(inseqs + inseqs + inseqs).batched(2)]
+        [2, 2, 2]
+        """
+
+        seqs = iter(self.seqs)
+        while True:
+            batch = list(islice(seqs, n))
+            if len(batch) == 0:
+                return
+
+            yield batch
+
+    def pipeline(self, *steps, n=1024):
+        """ Applies several functions to the sequences in a single pass.
+        Each step is a tuple of a Seq attribute name ("id", "desc" or "seq")
+        and a function to apply to it. Unlike the map methods, the Seq
+        objects are updated in place rather than copied, so only use this
+        for freshly parsed sequences.
+
+        Examples:
+        >>> inseqs = [Seq('test1', "desc", "atgca*")]
+        >>> seqs = Seqs(inseqs).pipeline(
+        ...     ("seq", lambda s: s.rstrip(b"*")),
+        ...     ("seq", bytes.upper),
+        ...     ("desc", lambda d: None),
+        ... )
+        >>> next(iter(seqs))
+        Seq(id='test1', desc='None', seq='b'ATGCA'')
+        """
+
+        return self.__class__(self._pipeline_batches(steps, n))
+
+    def _pipeline_batches(self, steps, n):
+        for batch in self.batched(n):
+            for attr, function in steps:
+                # getattr and setattr are much slower than plain attribute
+                # access, so the common case gets its own loop.
+                if attr == "seq":
+                    for record in batch:
+                        record.seq = function(record.seq)
+                else:
+                    for record in batch:
+                        setattr(record, attr, function(getattr(record, attr)))
+
+            yield from batch
+        return
+
+    def upper_all(self, n=1024):
+        """ Converts all sequences to uppercase, a batch at a time.
+        Like pipeline, the Seq objects are updated in place.
+
+        Examples:
+        >>> seqs = Seqs([Seq('test1', None, "atgca")]).upper_all()
+        >>> next(iter(seqs))
+        Seq(id='test1', desc='None', seq='b'ATGCA'')
+        """
+
+        return self.pipeline(("seq", bytes.upper), n=n)
+
+    def rstrip_all(self, chars, n=1024):
+        """ Strips bytes from the end of all sequences, a batch at a time.
+        Like pipeline, the Seq objects are updated in place.
+
+        Examples:
+        >>> seqs = Seqs([Seq('test1', None, "MAGNIFIQUE*")]).rstrip_all(b"*")
+        >>> next(iter(seqs))
+        Seq(id='test1', desc='None', seq='b'MAGNIFIQUE'')
+        """
+
+        return self.pipeline(("seq", lambda s: s.rstrip(chars)), n=n)
+
     def deduplicated(self, id_conv, column="id"):
         """ Removes duplicates from a Seqs object and stores a mapping file.
 
@@ -446,9 +799,12 @@ class Seqs(object):
 
         return SeqDeduplicated(self.seqs, column=column, id_conv=id_conv)
 
-    def replace_ids(self, id_conv, column="id"):
+    def replace_ids(self, id_conv, column="id", unique_ids=False):
         """ Replaces all seq ids given a function and stores a mapping file.
 
+        If unique_ids is True, id_conv is assumed to generate a fresh id
+        on every call so repeated ids aren't looked up.
+
         Examples:
         >>> inseqs = [
         ...     Seq('test1', None, "ATGCA"),
@@ -469,8 +825,25 @@ class Seqs(object):
         ('2tset', 'test2')
         >>> seqs.id_map[2][0], seqs.id_map[2][1]
         ('3tset', 'test3')
+
+        Repeated ids get the same new id, unless unique_ids is set.
+        >>> inseqs = [Seq('test1', None, "ATGCA"), Seq('test1', None, "A")]
+        >>> new_ids = iter(["SR1", "SR2"])
+        >>> [s.id for s in Seqs(inseqs).replace_ids(lambda i: next(new_ids))]
+        ['SR1', 'SR1']
+        >>> new_ids = iter(["SR1", "SR2"])
+        >>> [s.id for s in Seqs(inseqs).replace_ids(
+        ...     lambda i: next(new_ids),
+        ...     unique_ids=True
+        ... )]
+        ['SR1', 'SR2']
         """
-        return SeqReId(self.seqs, column=column, id_conv=id_conv)
+        return SeqReId(
+            self.seqs,
+            column=column,
+            id_conv=id_conv,
+            unique_ids=unique_ids
+        )
 
     def __iter__(self):
         return iter(self.seqs)
@@ -508,76 +881,106 @@ class SeqDeduplicated(Seqs):
         return
 
     def _filter_id(self, seqs, id_conv=None):
+        # Keyed by the raw digest, it's only converted to a seguid
+        # checksum when the ids are written out. It's computed inline
+        # rather than with Seq.digest to save a method call per record.
         seen = dict()
+        seen_get = seen.get
+        id_map_append = self.id_map.append
         for record in seqs:
-            checksum = record.checksum()
+            digest = sha1(record.seq).digest()
+            new_id = seen_get(digest)
 
-            if checksum in seen:
-                new_id = seen[checksum]
-                self.id_map.append((new_id, record.id, checksum, record.desc))
-            else:
+            if new_id is None:
                 new_id = id_conv(record.id)
-                self.id_map.append((new_id, record.id, checksum, record.desc))
-                seen[checksum] = new_id
-
+                seen[digest] = new_id
+                id_map_append((new_id, record.id, digest, record.desc))
                 yield Seq(new_id, record.desc, record.seq)
+            else:
+                id_map_append((new_id, record.id, digest, record.desc))
         return
 
     def _filter_desc(self, seqs, id_conv=None):
         seen = dict()
+        seen_get = seen.get
+        id_map_append = self.id_map.append
         for record in seqs:
-            checksum = record.checksum()
+            digest = sha1(record.seq).digest()
+            new_desc = seen_get(digest)
 
-            if checksum in seen:
-                new_desc = seen[checksum]
-                self.id_map.append((
-                    new_desc, record.desc, checksum, record.id
-                ))
-            else:
+            if new_desc is None:
                 new_desc = id_conv(record.desc)
-                self.id_map.append((
-                    new_desc, record.desc, checksum, record.id
-                ))
-                seen[checksum] = new_desc
-
+                seen[digest] = new_desc
+                id_map_append((new_desc, record.desc, digest, record.id))
                 yield Seq(record.id, record.desc, record.seq)
+            else:
+                id_map_append((new_desc, record.desc, digest, record.id))
         return
 
     def flush_ids(self, handle):
-        for new_id, old_id, checksum, old_desc in self.id_map:
-            if old_desc is None:
-                old_desc = "."
-            handle.write(f"{new_id}\t{old_id}\t{checksum}\t{old_desc}\n")
-
-        self.id_map = list()
+        seguid = Seq.seguid
+        handle.write("".join([
+            f"{new_id}\t{old_id}\t{seguid(digest)}\t"
+            f"{'.' if old_desc is None else old_desc}\n"
+            for new_id, old_id, digest, old_desc
+            in self.id_map
+        ]))
+
+        # Cleared rather than replaced, so the filters can keep a bound
+        # append method.
+        self.id_map.clear()
         return
 
 
 class SeqReId(Seqs):
 
-    def __init__(self, seqs, column="id", id_conv=lambda x: x):
+    def __init__(
+        self,
+        seqs,
+        column="id",
+        id_conv=lambda x: x,
+        unique_ids=False
+    ):
         self.id_map = list()
         if column == "desc":
-            self.seqs = self._filter_desc(seqs, id_conv)
+            self.seqs = self._filter_desc(seqs, id_conv, unique_ids)
         else:
-            self.seqs = self._filter_id(seqs, id_conv)
+            self.seqs = self._filter_id(seqs, id_conv, unique_ids)
         return
 
-    def _filter_id(self, seqs, id_conv=None):
+    def _filter_id(self, seqs, id_conv=None, unique_ids=False):
+        id_map_append = self.id_map.append
+
+        if unique_ids:
+            for record in seqs:
+                new_id = id_conv(record.id)
+                id_map_append((new_id, record.id, record.desc))
+                yield Seq(new_id, record.desc, record.seq)
+            return
+
         seen = dict()
         for record in seqs:
             if record.id in seen:
-                new_id = self.seen[record.id]
+                new_id = seen[record.id]
             else:
                 new_id = id_conv(record.id)
                 seen[record.id] = new_id
 
-            self.id_map.append((new_id, record.id, record.desc))
+            id_map_append((new_id, record.id, record.desc))
 
             yield Seq(new_id, record.desc, record.seq)
         return
 
-    def _filter_desc(self, seqs, id_conv=None):
+    def _filter_desc(self, seqs, id_conv=None, unique_ids=False):
+        id_map_append = self.id_map.append
+
+        if unique_ids:
+            for record in seqs:
+                new_desc = id_conv(record.desc)
+                id_map_append((new_desc, record.desc, record.id))
+                yield Seq(record.id, new_desc, record.seq)
+            return
+
         seen = dict()
         for record in seqs:
             if record.desc in seen:
@@ -586,16 +989,17 @@ class SeqReId(Seqs):
                 new_desc = id_conv(record.desc)
                 seen[record.desc] = new_desc
 
-            self.id_map.append((new_desc, record.desc, record.id))
+            id_map_append((new_desc, record.desc, record.id))
 
             yield Seq(record.id, new_desc, record.seq)
         return
 
     def flush_ids(self, handle):
-        for new_id, old_id, old_desc in self.id_map:
-            if old_desc is None:
-                old_desc = "."
-            handle.write(f"{new_id}\t{old_id}\t{old_desc}\n")
+        handle.write("".join([
+            f"{new_id}\t{old_id}\t{'.' if old_desc is None else old_desc}\n"
+            for new_id, old_id, old_desc
+            in self.id_map
+        ]))
 
-        self.id_map = list()
+        self.id_map.clear()
         return
@@ -1,4 +1,6 @@
 import csv
+from itertools import chain
+
 from seqrenamer.exceptions import XsvColumnNumberError
 
 
@@ -6,44 +8,105 @@ class Xsv(object):
 
     def __init__(self, handle, comment="#", sep=","):
 
-        self.handle = self._filter_comments(handle, comment)
+        self.handle = handle
+        self.comment = comment
         self.id_map = list()
         self.sep = sep
         return
 
     def __iter__(self):
-        csv_reader = csv.reader(
-            self.handle,
+        """ Splits lines into rows, only using the csv module for quotes.
+
+        Examples:
+        >>> lines = ['a\\tb\\n', '\\n', 'c\\t"d\\n', 'e"\\tf\\n', 'g\\th']
+        >>> list(Xsv(lines, sep="\\t"))
+        [['a', 'b'], [], ['c', 'd\\ne', 'f'], ['g', 'h']]
+        >>> list(Xsv(['"a"\\tb\\n', 'c\\td\\n'], sep="\\t"))
+        [['a', 'b'], ['c', 'd']]
+        >>> list(Xsv(['#a,b\\n', 'c,d\\n', '#e\\n', 'f,g\\n']))
+        [['c', 'd'], ['f', 'g']]
+        """
+
+        comment = self.comment
+        lines = iter(self.handle)
+
+        for first in lines:
+            if not first.startswith(comment):
+                break
+        else:
+            return iter([])
+
+        # Files with quoting usually quote throughout, so they go straight
+        # to the csv module without the overhead of checking each line.
+        if '"' in first:
+            return self._csv_rows(chain((first, ), lines))
+        else:
+            return self._split_rows(chain((first, ), lines))
+
+    def _csv_rows(self, lines):
+        return csv.reader(
+            self._filter_comments(lines, self.comment),
             delimiter=self.sep,
             dialect='excel'
         )
 
-        for row in csv_reader:
-            yield row
+    def _split_rows(self, lines):
+        sep = self.sep
+        comment = self.comment
+
+        # Comments are skipped here rather than with _filter_comments, to
+        # save passing every line through another generator.
+        for line in lines:
+            if line.startswith(comment):
+                continue
+
+            if '"' in line:
+                # Quoted fields can span lines, so the csv module takes
+                # over for the rest of the file.
+                yield from self._csv_rows(chain((line, ), lines))
+                return
+
+            line = line.rstrip("\r\n")
+            if line:
+                yield line.split(sep)
+            else:
+                yield []
 
         return
 
     def replace_ids(self, id_conv, column, header):
+        """ Replaces the ids in a column, calling id_conv once per distinct id.
+
+        Examples:
+        >>> from io import StringIO
+        >>> handle = StringIO("a,1\\nb,2\\na,3\\n")
+        >>> new_ids = iter(["SR1", "SR2"])
+        >>> xsv = Xsv(handle)
+        >>> list(xsv.replace_ids(lambda i: next(new_ids), 0, header=False))
+        [['SR1', '1'], ['SR2', '2'], ['SR1', '3']]
+        >>> xsv.id_map
+        [('SR1', 'a'), ('SR2', 'b')]
+        """
+
         csv_reader = iter(self)
-        seen = dict()
 
-        for row in csv_reader:
-            if header:
-                header = False
+        if header:
+            for row in csv_reader:
                 yield row
-                continue
+                break
 
-            try:
-                old_id = row[column]
-
-                if old_id in seen:
-                    new_id = seen[old_id]
-                else:
-                    new_id = id_conv(old_id)
-                    seen[old_id] = new_id
+        seen = dict()
+        seen_get = seen.get
+        id_map_append = self.id_map.append
 
-                row[column] = new_id
+        # Rows sharing an id are usually adjacent (e.g. blast hits for a
+        # query), so the last id is checked before hashing.
+        last_old_id = None
+        last_new_id = None
 
+        for row in csv_reader:
+            try:
+                old_id = row[column]
             except IndexError:
                 joined_line = self.sep.join(map(str, row))
                 raise XsvColumnNumberError(
@@ -51,16 +114,36 @@ class Xsv(object):
                     f"The offending line was: {joined_line}."
                 )
 
-            self.id_map.append((new_id, old_id))
+            if old_id == last_old_id:
+                row[column] = last_new_id
+                yield row
+                continue
+
+            new_id = seen_get(old_id)
+            if new_id is None:
+                new_id = id_conv(old_id)
+                seen[old_id] = new_id
+
+                # Only new ids go in the map, otherwise decoding would
+                # duplicate every row that shares an id.
+                id_map_append((new_id, old_id))
+
+            last_old_id = old_id
+            last_new_id = new_id
+
+            row[column] = new_id
             yield row
 
         return
 
     def flush_ids(self, handle):
-        for new_id, old_id in self.id_map:
-            handle.write(f"{new_id}\t{old_id}\n")
+        handle.write("".join([
+            f"{new_id}\t{old_id}\n"
+            for new_id, old_id
+            in self.id_map
+        ]))
 
-        self.id_map = list()
+        self.id_map.clear()
         return
 
     @staticmethod
@@ -69,3 +152,50 @@ class Xsv(object):
             if not line.startswith(comment):
                 yield line
         return
+
+
+def write_rows(handle, rows, sep):
+    """ Writes rows as csv.writer would with the excel dialect.
+
+    If no row in the batch needs quoting the rows are joined directly,
+    otherwise the csv module writes the whole batch.
+
+    Examples:
+    >>> from io import StringIO
+    >>> handle = StringIO()
+    >>> write_rows(handle, [["a", "b"], ["c", ""]], ",")
+    >>> write_rows(handle, [["c,d", "e"], [""], []], ",")
+    >>> handle.getvalue()
+    'a,b\\r\\nc,\\r\\n"c,d",e\\r\\n""\\r\\n\\r\\n'
+    """
+
+    if len(rows) == 0:
+        return
+
+    csv_writer = csv.writer(handle, delimiter=sep, dialect='excel')
+
+    # Quoting is usually all or nothing, so the first row decides whether
+    # it's worth joining the rest.
+    first = sep.join(rows[0])
+    if '"' in first or first.count(sep) != len(rows[0]) - 1:
+        csv_writer.writerows(rows)
+        return
+
+    lines = [sep.join(row) for row in rows]
+    text = "".join(lines)
+
+    # Fields containing any of these need quoting. Empty lines need it
+    # too, because csv writes a lone empty field as "".
+    if (
+        '"' in text
+        or "\n" in text
+        or "\r" in text
+        or text.count(sep) != sum(map(len, rows)) - len(rows)
+        or "" in lines
+    ):
+        csv_writer.writerows(rows)
+        return
+
+    lines.append("")
+    handle.write("\r\n".join(lines))
+    return